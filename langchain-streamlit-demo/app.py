@@ -1,9 +1,13 @@
+import asyncio
+import atexit
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from typing import Tuple, List, Dict, Any, Union, Optional
+from uuid import UUID
 
-import anthropic
 import langsmith.utils
-import openai
 import streamlit as st
 from langchain.agents import load_tools
 from langchain.agents.tools import tool
@@ -12,18 +16,25 @@ from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.manager import Callbacks
 from langchain.callbacks.tracers.langchain import LangChainTracer, wait_for_all_tracers
 from langchain.callbacks.tracers.run_collector import RunCollectorCallbackHandler
-from langchain.memory import ConversationBufferMemory, StreamlitChatMessageHistory
+from langchain.memory import (
+    ConversationBufferWindowMemory,
+    StreamlitChatMessageHistory,
+)
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.schema.document import Document
 from langchain.schema.retriever import BaseRetriever
 from langchain.tools import DuckDuckGoSearchRun, WikipediaQueryRun
 from langchain.utilities import WikipediaAPIWrapper
 from langsmith.client import Client
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 from streamlit_feedback import streamlit_feedback
 
 from defaults import default_values
 from llm_resources import (
+    StreamHandler,
     get_agent,
+    get_auth_error_types,
+    get_chunk_text,
     get_doc_agent,
     get_llm,
     get_runnable,
@@ -34,6 +45,8 @@ from research_assistant.chain import get_chain as get_research_assistant_chain
 
 __version__ = "2.1.4"
 
+logger = logging.getLogger(__name__)
+
 # --- Initialization ---
 st.set_page_config(
     page_title=f"langchain-streamlit-demo v{__version__}",
@@ -72,14 +85,22 @@ st_init_null(
 
 # --- LLM globals ---
 STMEMORY = StreamlitChatMessageHistory(key="langchain_messages")
-MEMORY = ConversationBufferMemory(
+MEMORY = ConversationBufferWindowMemory(
     chat_memory=STMEMORY,
     return_messages=True,
     memory_key="chat_history",
+    k=default_values.MEMORY_WINDOW_K,
 )
 
 RUN_COLLECTOR = RunCollectorCallbackHandler()
 
+AI_MESSAGE_TYPES = frozenset(("ai", "assistant"))
+CHAT_MESSAGE_TYPES = AI_MESSAGE_TYPES | {"human", "user"}
+
+# Document chat chain types that fan out into several LLM calls per query,
+# which only run concurrently when the chain is invoked asynchronously.
+CONCURRENT_CHAIN_TYPES = ("map_reduce", "map_rerank")
+
 st.session_state.LANGSMITH_API_KEY = (
     st.session_state.LANGSMITH_API_KEY
     or default_values.PROVIDER_KEY_DICT.get("LANGSMITH")
@@ -108,14 +129,12 @@ azure_state_or_default(
     "AZURE_OPENAI_MODEL_VERSION",
 )
 
-st.session_state.AZURE_AVAILABLE = all(
-    [
-        st.session_state.AZURE_OPENAI_BASE_URL,
-        st.session_state.AZURE_OPENAI_API_VERSION,
-        st.session_state.AZURE_OPENAI_DEPLOYMENT_NAME,
-        st.session_state.AZURE_OPENAI_API_KEY,
-        st.session_state.AZURE_OPENAI_MODEL_VERSION,
-    ],
+st.session_state.AZURE_AVAILABLE = bool(
+    st.session_state.AZURE_OPENAI_BASE_URL
+    and st.session_state.AZURE_OPENAI_API_VERSION
+    and st.session_state.AZURE_OPENAI_DEPLOYMENT_NAME
+    and st.session_state.AZURE_OPENAI_API_KEY
+    and st.session_state.AZURE_OPENAI_MODEL_VERSION,
 )
 
 st.session_state.AZURE_EMB_AVAILABLE = (
@@ -136,6 +155,16 @@ AZURE_KWARGS = (
 )
 
 
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # One loop for the whole process: the cached LLMs and retrievers are shared
+    # across sessions, and their async HTTP pools are bound to the loop that
+    # first used them.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
 @st.cache_resource
 def get_texts_and_retriever_cacheable_wrapper(
     uploaded_file_bytes: bytes,
@@ -154,6 +183,134 @@ def get_texts_and_retriever_cacheable_wrapper(
         k=k,
         azure_kwargs=azure_kwargs,
         use_azure=use_azure,
+        event_loop=get_event_loop(),
+    )
+
+
+@st.cache_resource(max_entries=16)
+def get_llm_cacheable_wrapper(
+    provider: str,
+    model: str,
+    provider_api_key: str,
+    temperature: float,
+    max_tokens: int,
+    azure_available: bool,
+    azure_dict: Dict[str, str],
+):
+    return get_llm(
+        provider=provider,
+        model=model,
+        provider_api_key=provider_api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        azure_available=azure_available,
+        azure_dict=azure_dict,
+    )
+
+
+@st.cache_resource(max_entries=8)
+def get_langsmith_client(api_key: str) -> Client:
+    return Client(
+        api_url="https://api.smith.langchain.com",
+        api_key=api_key,
+    )
+
+
+@st.cache_resource(max_entries=8)
+def get_langsmith_tracer(api_key: str, project_name: str) -> LangChainTracer:
+    return LangChainTracer(
+        project_name=project_name,
+        client=get_langsmith_client(api_key),
+    )
+
+
+@st.cache_resource(max_entries=8)
+def get_langsmith_project_id(api_key: str, project_name: str) -> UUID:
+    return get_langsmith_client(api_key).read_project(project_name=project_name).id
+
+
+@st.cache_resource
+def get_feedback_executor() -> ThreadPoolExecutor:
+    executor = ThreadPoolExecutor(max_workers=2)
+    atexit.register(executor.shutdown, wait=True)
+    return executor
+
+
+def log_feedback_error(future: Future) -> None:
+    exception = future.exception()
+    if exception is not None:
+        logger.error("Failed to record feedback", exc_info=exception)
+
+
+def store_trace_link(client: Client, run_id) -> None:
+    wait_for_all_tracers()
+    try:
+        trace_link = client.read_run(run_id).url
+    except (
+        langsmith.utils.LangSmithError,
+        langsmith.utils.LangSmithNotFoundError,
+    ):
+        trace_link = None
+    if st.session_state.run_id == run_id:
+        st.session_state.trace_link = trace_link
+
+
+# Runs as a fragment so feedback clicks only rerun this widget,
+# not the whole app.
+@st.experimental_fragment
+def render_feedback(feedback_option: str) -> None:
+    feedback = streamlit_feedback(
+        feedback_type=feedback_option,
+        optional_text_label="[Optional] Please provide an explanation",
+        key=f"feedback_{st.session_state.run_id}",
+    )
+
+    # Get the score mapping based on the selected feedback option
+    scores = default_values.SCORE_MAPPINGS[feedback_option]
+
+    if feedback:
+        # Get the score from the selected feedback option's score mapping
+        score = scores.get(
+            feedback["score"],
+        )
+
+        if score is not None:
+            # Formulate feedback type string incorporating the feedback option
+            # and score value
+            feedback_type_str = f"{feedback_option} {feedback['score']}"
+
+            # Record the feedback with the formulated feedback type string
+            # and optional comment, without waiting on the request
+            feedback_future = get_feedback_executor().submit(
+                st.session_state.client.create_feedback,
+                st.session_state.run_id,
+                feedback_type_str,
+                score=score,
+                comment=feedback.get("text"),
+            )
+            feedback_future.add_done_callback(log_feedback_error)
+            st.toast("Feedback recorded!", icon="📝")
+        else:
+            st.warning("Invalid feedback score.")
+
+
+@st.cache_resource(max_entries=16)
+def build_chat_prompt(
+    system_prompt: str,
+    include_history: bool = True,
+) -> ChatPromptTemplate:
+    history = (
+        [MessagesPlaceholder(variable_name="chat_history")] if include_history else []
+    )
+    return ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                system_prompt + "\nIt's currently {time}.",
+            ),
+            *history,
+            ("human", "{query}"),
+        ],
     )
 
 
@@ -228,20 +385,6 @@ with sidebar:
             value=default_values.DEFAULT_CHUNK_OVERLAP,
         )
 
-        chain_type_help_root = (
-            "https://python.langchain.com/docs/modules/chains/document/"
-        )
-
-        chain_type_help = "\n".join(
-            f"- [{chain_type_name}]({chain_type_help_root}/{chain_type_name})"
-            for chain_type_name in (
-                "stuff",
-                "refine",
-                "map_reduce",
-                "map_rerank",
-            )
-        )
-
         document_chat_chain_type = st.selectbox(
             label="Document Chat Chain Type",
             options=[
@@ -253,7 +396,7 @@ with sidebar:
                 "Summarization",
             ],
             index=0,
-            help=chain_type_help,
+            help=default_values.CHAIN_TYPE_HELP,
         )
         use_azure = st.toggle(
             label="Use Azure OpenAI",
@@ -325,15 +468,17 @@ with sidebar:
                 value=st.session_state.LANGSMITH_PROJECT,
             )
 
-    if st.session_state.client is None and st.session_state.LANGSMITH_API_KEY:
-        st.session_state.client = Client(
-            api_url="https://api.smith.langchain.com",
-            api_key=st.session_state.LANGSMITH_API_KEY,
+    if st.session_state.LANGSMITH_API_KEY:
+        st.session_state.client = get_langsmith_client(
+            st.session_state.LANGSMITH_API_KEY,
         )
-        st.session_state.ls_tracer = LangChainTracer(
-            project_name=st.session_state.LANGSMITH_PROJECT,
-            client=st.session_state.client,
+        st.session_state.ls_tracer = get_langsmith_tracer(
+            st.session_state.LANGSMITH_API_KEY,
+            st.session_state.LANGSMITH_PROJECT,
         )
+    else:
+        st.session_state.client = None
+        st.session_state.ls_tracer = None
 
     # --- Azure Options ---
     if default_values.SHOW_AZURE_OPTIONS:
@@ -387,41 +532,39 @@ get_llm_args = dict(
     },
 )
 get_llm_args_temp_zero = get_llm_args | {"temperature": 0.0}
-st.session_state.llm = get_llm(**get_llm_args)
+st.session_state.llm = get_llm_cacheable_wrapper(**get_llm_args)
 
 # --- Chat History ---
+# Streamlit clears any element a rerun doesn't write again, so the whole
+# history has to be rendered on every rerun; only the frontend diff is sent.
 for msg in STMEMORY.messages:
-    if msg.content and msg.type in ("ai", "assistant", "human", "user"):
+    if msg.content and msg.type in CHAT_MESSAGE_TYPES:
         st.chat_message(
             msg.type,
-            avatar="🦜" if msg.type in ("ai", "assistant") else None,
+            avatar="🦜" if msg.type in AI_MESSAGE_TYPES else None,
         ).write(msg.content)
 
 
 # --- Current Chat ---
 if st.session_state.llm:
-    # --- Regular Chat ---
-    chat_prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                system_prompt + "\nIt's currently {time}.",
-            ),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{query}"),
-        ],
-    ).partial(time=lambda: str(datetime.now()))
-
     # --- Chat Input ---
     prompt = st.chat_input(placeholder="Ask me a question!")
     if prompt:
+        # --- Regular Chat ---
+        # Skip the history placeholder on the first turn, and use one timestamp
+        # per turn, shared by every LLM call the chain makes
+        chat_prompt = build_chat_prompt(
+            system_prompt,
+            include_history=bool(STMEMORY.messages),
+        ).partial(
+            time=datetime.now().isoformat(timespec="seconds"),
+        )
         st.chat_message("user").write(prompt)
         feedback_update = None
-        feedback = None
 
         # --- Chat Output ---
         with st.chat_message("assistant", avatar="🦜"):
-            callbacks = [RUN_COLLECTOR]
+            callbacks: List[BaseCallbackHandler] = [RUN_COLLECTOR]
 
             if st.session_state.ls_tracer:
                 callbacks.append(st.session_state.ls_tracer)
@@ -444,10 +587,10 @@ if st.session_state.llm:
                 ],
             )
 
+            use_async_invoke = False
             full_response: Union[str, None] = None
-            # stream_handler = StreamHandler(message_placeholder)
-            # callbacks.append(stream_handler)
             message_placeholder = st.empty()
+            stream_handler = StreamHandler(message_placeholder)
             default_tools = [
                 DuckDuckGoSearchRun(),
                 WikipediaQueryRun(api_wrapper=WikipediaAPIWrapper()),
@@ -456,8 +599,8 @@ if st.session_state.llm:
             default_tools += load_tools(["llm-math"], llm=st.session_state.llm)
             if st.session_state.provider in ("Azure OpenAI", "OpenAI"):
                 research_assistant_chain = get_research_assistant_chain(
-                    search_llm=get_llm(**get_llm_args_temp_zero),  # type: ignore
-                    writer_llm=get_llm(**get_llm_args_temp_zero),  # type: ignore
+                    search_llm=get_llm_cacheable_wrapper(**get_llm_args_temp_zero),  # type: ignore
+                    writer_llm=get_llm_cacheable_wrapper(**get_llm_args_temp_zero),  # type: ignore
                 )
                 st_callback = StreamlitCallbackHandler(st.container())
                 callbacks.append(st_callback)
@@ -541,15 +684,33 @@ if st.session_state.llm:
                     chat_prompt,
                     prompt,
                 )
+                use_async_invoke = (
+                    use_document_chat
+                    and document_chat_chain_type in CONCURRENT_CHAIN_TYPES
+                )
+                if not use_async_invoke:
+                    callbacks.append(stream_handler)
 
             # --- LLM call ---
             try:
-                full_response = st.session_state.chain.invoke(
-                    prompt,
-                    config=get_config(callbacks),
-                )
+                if use_async_invoke:
+                    full_response = asyncio.run_coroutine_threadsafe(
+                        st.session_state.chain.ainvoke(
+                            prompt,
+                            config=get_config(callbacks),
+                        ),
+                        get_event_loop(),
+                    ).result()
+                else:
+                    streamed_response = ""
+                    for chunk in st.session_state.chain.stream(
+                        prompt,
+                        config=get_config(callbacks),
+                    ):
+                        streamed_response += get_chunk_text(chunk)
+                    full_response = streamed_response
 
-            except (openai.AuthenticationError, anthropic.AuthenticationError):
+            except get_auth_error_types():
                 st.error(
                     f"Please enter a valid {st.session_state.provider} API key.",
                     icon="❌",
@@ -564,16 +725,36 @@ if st.session_state.llm:
                     st.session_state.run = RUN_COLLECTOR.traced_runs[0]
                     st.session_state.run_id = st.session_state.run.id
                     RUN_COLLECTOR.traced_runs = []
-                    wait_for_all_tracers()
                     try:
-                        st.session_state.trace_link = st.session_state.client.read_run(
-                            st.session_state.run_id,
-                        ).url
+                        st.session_state.trace_link = (
+                            st.session_state.client.get_run_url(
+                                run=st.session_state.run,
+                                project_id=get_langsmith_project_id(
+                                    st.session_state.LANGSMITH_API_KEY,
+                                    st.session_state.LANGSMITH_PROJECT,
+                                ),
+                            )
+                        )
+                        trace_thread = threading.Thread(
+                            target=wait_for_all_tracers,
+                            daemon=True,
+                        )
                     except (
                         langsmith.utils.LangSmithError,
                         langsmith.utils.LangSmithNotFoundError,
                     ):
+                        # The project may not exist until the first traces are
+                        # uploaded; the link shows up in the sidebar on the
+                        # next rerun once it's resolved.
                         st.session_state.trace_link = None
+                        trace_thread = threading.Thread(
+                            target=store_trace_link,
+                            args=(st.session_state.client, st.session_state.run_id),
+                            daemon=True,
+                        )
+                    # Upload traces without blocking the UI
+                    add_script_run_ctx(trace_thread)
+                    trace_thread.start()
 
     # --- LangSmith Trace Link ---
     if st.session_state.trace_link:
@@ -585,43 +766,7 @@ if st.session_state.llm:
 
     # --- Feedback ---
     if st.session_state.client and st.session_state.run_id:
-        feedback = streamlit_feedback(
-            feedback_type=feedback_option,
-            optional_text_label="[Optional] Please provide an explanation",
-            key=f"feedback_{st.session_state.run_id}",
-        )
-
-        # Define score mappings for both "thumbs" and "faces" feedback systems
-        score_mappings: dict[str, dict[str, Union[int, float]]] = {
-            "thumbs": {"👍": 1, "👎": 0},
-            "faces": {"😀": 1, "🙂": 0.75, "😐": 0.5, "🙁": 0.25, "😞": 0},
-        }
-
-        # Get the score mapping based on the selected feedback option
-        scores = score_mappings[feedback_option]
-
-        if feedback:
-            # Get the score from the selected feedback option's score mapping
-            score = scores.get(
-                feedback["score"],
-            )
-
-            if score is not None:
-                # Formulate feedback type string incorporating the feedback option
-                # and score value
-                feedback_type_str = f"{feedback_option} {feedback['score']}"
-
-                # Record the feedback with the formulated feedback type string
-                # and optional comment
-                feedback_record = st.session_state.client.create_feedback(
-                    st.session_state.run_id,
-                    feedback_type_str,
-                    score=score,
-                    comment=feedback.get("text"),
-                )
-                st.toast("Feedback recorded!", icon="📝")
-            else:
-                st.warning("Invalid feedback score.")
+        render_feedback(feedback_option)
 
 else:
     st.error(f"Please enter a valid {st.session_state.provider} API key.", icon="❌")
@@ -75,6 +75,33 @@ DEFAULT_CHUNK_OVERLAP = 0
 
 DEFAULT_RETRIEVER_K = 4
 
+# Number of previous exchanges (human + AI message pairs) sent with each prompt
+MEMORY_WINDOW_K = int(os.environ.get("MEMORY_WINDOW_K", 20))
+
+EMBEDDING_CACHE_DIR = os.path.expanduser(
+    os.environ.get(
+        "EMBEDDING_CACHE_DIR",
+        "~/.cache/langchain-streamlit-demo/embeddings",
+    ),
+)
+
+# Score mappings for both "thumbs" and "faces" feedback systems
+SCORE_MAPPINGS = {
+    "thumbs": {"👍": 1, "👎": 0},
+    "faces": {"😀": 1, "🙂": 0.75, "😐": 0.5, "🙁": 0.25, "😞": 0},
+}
+
+CHAIN_TYPE_HELP_ROOT = "https://python.langchain.com/docs/modules/chains/document/"
+CHAIN_TYPE_HELP = "\n".join(
+    f"- [{chain_type_name}]({CHAIN_TYPE_HELP_ROOT}/{chain_type_name})"
+    for chain_type_name in (
+        "stuff",
+        "refine",
+        "map_reduce",
+        "map_rerank",
+    )
+)
+
 DEFAULT_VALUES = namedtuple(
     "DEFAULT_VALUES",
     [
@@ -100,8 +127,11 @@ DEFAULT_VALUES = namedtuple(
         "MAX_CHUNK_OVERLAP",
         "DEFAULT_CHUNK_OVERLAP",
         "DEFAULT_RETRIEVER_K",
+        "MEMORY_WINDOW_K",
         "SHOW_LANGSMITH_OPTIONS",
         "SHOW_AZURE_OPTIONS",
+        "SCORE_MAPPINGS",
+        "CHAIN_TYPE_HELP",
     ],
 )
 
@@ -129,6 +159,9 @@ default_values = DEFAULT_VALUES(
     MAX_CHUNK_OVERLAP,
     DEFAULT_CHUNK_OVERLAP,
     DEFAULT_RETRIEVER_K,
+    MEMORY_WINDOW_K,
     SHOW_LANGSMITH_OPTIONS,
     SHOW_AZURE_OPTIONS,
+    SCORE_MAPPINGS,
+    CHAIN_TYPE_HELP,
 )
@@ -1,7 +1,13 @@
+import asyncio
+import re
+import time
 import uuid
+from functools import lru_cache
 from tempfile import NamedTemporaryFile
-from typing import Tuple, List, Optional, Dict
+from typing import Tuple, List, Optional, Dict, Any, Type
 
+import faiss
+import numpy as np
 from langchain.agents import AgentExecutor, AgentType, initialize_agent
 from langchain.agents.openai_functions_agent.base import OpenAIFunctionsAgent
 from langchain.callbacks.base import BaseCallbackHandler
@@ -13,27 +19,48 @@ from langchain.chat_models import (
     ChatAnthropic,
     ChatAnyscale,
 )
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.document_loaders import PyPDFLoader
-from langchain.embeddings import AzureOpenAIEmbeddings, OpenAIEmbeddings
+from langchain.embeddings import (
+    AzureOpenAIEmbeddings,
+    CacheBackedEmbeddings,
+    OpenAIEmbeddings,
+)
 from langchain.llms.base import BaseLLM
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import MessagesPlaceholder, ChatPromptTemplate
 from langchain.retrievers import EnsembleRetriever
 from langchain.retrievers.multi_query import MultiQueryRetriever
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.schema import Document, BaseRetriever
+from langchain.schema import Document, BaseRetriever, LLMResult
 from langchain.schema.chat_history import BaseChatMessageHistory
+from langchain.schema.embeddings import Embeddings
 from langchain.schema.runnable import RunnablePassthrough
-from langchain.storage import InMemoryStore
+from langchain.storage import InMemoryStore, LocalFileStore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.tools.base import BaseTool
 from langchain.vectorstores import FAISS
 from langchain_core.messages import SystemMessage
 
-from defaults import DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP, DEFAULT_RETRIEVER_K
+from defaults import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_RETRIEVER_K,
+    EMBEDDING_CACHE_DIR,
+)
 from qagen import get_rag_qa_gen_chain
 from summarize import get_rag_summarization_chain
 
+# Above this many chunks, exact (flat) search gets slow enough that an
+# approximate HNSW index is worth its small recall loss.
+HNSW_MIN_DOCUMENTS = 1000
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 40
+
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_MAX_CONCURRENCY = 10
+
 
 def get_agent(
     tools: list[BaseTool],
@@ -213,6 +240,83 @@ def get_llm(
     return None
 
 
+@lru_cache(maxsize=None)
+def get_auth_error_types() -> Tuple[Type[Exception], ...]:
+    # Provider SDKs are only imported once an error needs to be matched
+    import anthropic
+    import openai
+
+    return openai.AuthenticationError, anthropic.AuthenticationError
+
+
+async def aembed_documents(
+    embeddings: Embeddings,
+    texts: List[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+) -> List[List[float]]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def aembed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    batch_vectors = await asyncio.gather(*(aembed_batch(batch) for batch in batches))
+    return [vector for vectors in batch_vectors for vector in vectors]
+
+
+def embed_document_sets(
+    embeddings: Embeddings,
+    document_sets: List[List[Document]],
+    event_loop: Optional[asyncio.AbstractEventLoop] = None,
+) -> List[List[List[float]]]:
+    # All sets are embedded under a single event loop: the embedder's async
+    # HTTP pool is bound to the loop that first uses it, so a second
+    # asyncio.run() would hit connections from a closed loop.
+    texts = [
+        document.page_content for documents in document_sets for document in documents
+    ]
+    coroutine = aembed_documents(embeddings, texts)
+    if event_loop is None:
+        vectors = asyncio.run(coroutine)
+    else:
+        vectors = asyncio.run_coroutine_threadsafe(coroutine, event_loop).result()
+
+    vector_sets = []
+    start = 0
+    for documents in document_sets:
+        vector_sets.append(vectors[start : start + len(documents)])
+        start += len(documents)
+    return vector_sets
+
+
+def get_vectorstore(
+    documents: List[Document],
+    vectors: List[List[float]],
+    embeddings: Embeddings,
+) -> FAISS:
+    texts = [document.page_content for document in documents]
+    dimension = len(vectors[0])
+
+    # Vectors are stored as 8-bit scalar-quantized codes, a quarter of the
+    # memory of float32 with a negligible effect on recall.
+    if len(documents) > HNSW_MIN_DOCUMENTS:
+        index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+    index.train(np.array(vectors, dtype=np.float32))
+
+    vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(
+        zip(texts, vectors),
+        metadatas=[document.metadata for document in documents],
+    )
+    return vectorstore
+
+
 def get_texts_and_multiretriever(
     uploaded_file_bytes: bytes,
     openai_api_key: str,
@@ -221,6 +325,7 @@ def get_texts_and_multiretriever(
     k: int = DEFAULT_RETRIEVER_K,
     azure_kwargs: Optional[Dict[str, str]] = None,
     use_azure: bool = False,
+    event_loop: Optional[asyncio.AbstractEventLoop] = None,
 ) -> Tuple[List[Document], BaseRetriever]:
     with NamedTemporaryFile() as temp_file:
         temp_file.write(uploaded_file_bytes)
@@ -246,17 +351,54 @@ def get_texts_and_multiretriever(
                 _text.metadata[id_key] = _id
             sub_texts.extend(_sub_texts)
 
-        embeddings_kwargs = {"openai_api_key": openai_api_key}
+        embeddings_kwargs: Dict[str, Any] = {
+            "openai_api_key": openai_api_key,
+            "max_retries": 5,
+            "request_timeout": 30,
+        }
         if use_azure and azure_kwargs:
+            azure_kwargs = dict(azure_kwargs)
             azure_kwargs["azure_endpoint"] = azure_kwargs.pop("openai_api_base")
             embeddings_kwargs.update(azure_kwargs)
-            embeddings = AzureOpenAIEmbeddings(**embeddings_kwargs)
+            underlying_embeddings = AzureOpenAIEmbeddings(**embeddings_kwargs)
+            # .model doesn't reflect the Azure deployment, which is what
+            # actually determines the embedding model
+            cache_namespace = "-".join(
+                (
+                    type(underlying_embeddings).__name__,
+                    azure_kwargs["azure_endpoint"],
+                    azure_kwargs["deployment"],
+                ),
+            )
         else:
-            embeddings = OpenAIEmbeddings(**embeddings_kwargs)
+            underlying_embeddings = OpenAIEmbeddings(**embeddings_kwargs)
+            cache_namespace = (
+                f"{type(underlying_embeddings).__name__}-{underlying_embeddings.model}"
+            )
+        # Chunks are cached on disk by content hash, so re-uploads and
+        # edited documents only embed the chunks that changed.
+        embeddings = CacheBackedEmbeddings.from_bytes_store(
+            underlying_embeddings,
+            LocalFileStore(EMBEDDING_CACHE_DIR),
+            # LocalFileStore only accepts [a-zA-Z0-9_.-/] in keys
+            namespace=re.sub(r"[^a-zA-Z0-9_.\-]", "_", cache_namespace),
+        )
         store = InMemoryStore()
 
+        multiquery_text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        multiquery_texts = multiquery_text_splitter.split_documents(documents)
+
+        sub_text_vectors, multiquery_vectors = embed_document_sets(
+            embeddings,
+            [sub_texts, multiquery_texts],
+            event_loop=event_loop,
+        )
+
         # MultiVectorRetriever
-        multivectorstore = FAISS.from_documents(sub_texts, embeddings)
+        multivectorstore = get_vectorstore(sub_texts, sub_text_vectors, embeddings)
         multivector_retriever = MultiVectorRetriever(
             vectorstore=multivectorstore,
             docstore=store,
@@ -265,13 +407,12 @@ def get_texts_and_multiretriever(
         multivector_retriever.docstore.mset(list(zip(text_ids, texts)))
         # multivector_retriever.k = k
 
-        multiquery_text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-        )
         # MultiQueryRetriever
-        multiquery_texts = multiquery_text_splitter.split_documents(documents)
-        multiquerystore = FAISS.from_documents(multiquery_texts, embeddings)
+        multiquerystore = get_vectorstore(
+            multiquery_texts,
+            multiquery_vectors,
+            embeddings,
+        )
         multiquery_retriever = MultiQueryRetriever.from_llm(
             retriever=multiquerystore.as_retriever(search_kwargs={"k": k}),
             llm=ChatOpenAI(),
@@ -284,11 +425,56 @@ def get_texts_and_multiretriever(
         return multiquery_texts, ensemble_retriever
 
 
+def get_chunk_text(chunk: Any) -> str:
+    if isinstance(chunk, str):
+        return chunk
+    if isinstance(chunk, dict):
+        for key in ("answer", "output_text", "output", "text"):
+            if isinstance(chunk.get(key), str):
+                return chunk[key]
+        return ""
+    return getattr(chunk, "content", "") or ""
+
+
 class StreamHandler(BaseCallbackHandler):
-    def __init__(self, container, initial_text=""):
+    def __init__(
+        self,
+        container,
+        initial_text="",
+        flush_every_n_tokens: int = 4,
+        flush_interval: float = 0.05,
+    ):
         self.container = container
+        self.initial_text = initial_text
         self.text = initial_text
+        self.flush_every_n_tokens = flush_every_n_tokens
+        self.flush_interval = flush_interval
+        self._pending_tokens = 0
+        self._last_flush = 0.0
+
+    def _flush(self) -> None:
+        self.container.markdown(self.text)
+        self._pending_tokens = 0
+        self._last_flush = time.monotonic()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs):
+        # Chains like refine and map_reduce make several LLM calls per answer;
+        # only show the tokens of the call that is currently generating.
+        self.text = self.initial_text
+        self._pending_tokens = 0
+        self._last_flush = 0.0
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
         self.text += token
-        self.container.markdown(self.text)
+        self._pending_tokens += 1
+        # Each markdown() call sends the whole text to the browser, so batch
+        # tokens; the first token still renders immediately.
+        if (
+            self._pending_tokens >= self.flush_every_n_tokens
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self._flush()
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        if self._pending_tokens:
+            self._flush()